@@ -1,49 +1,92 @@
 import os
+import re
 import json
+import hashlib
+import sqlite3
+import threading
+import time
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import fitz  # PyMuPDF
 import docx
-import pdfplumber
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Any, BinaryIO, List, Optional, Tuple
 from dotenv import load_dotenv
-from io import BytesIO
-from PIL import Image
+from PIL import Image, ImageFilter
+
+load_dotenv()
+
+# 200 DPI plus an unsharp mask reads as well as 300 DPI with ~2.25x fewer pixels for Tesseract
+OCR_DPI = 200
+
+# Hard cap on resume text sent to Gemini (~4k tokens). Latency is dominated by prefill, which
+# grows with input length, and CVs rarely carry new structured fields past the first few pages.
+MAX_PROMPT_CHARS = 16000
+
+# Uploads are hashed in 64 KB chunks
+UPLOAD_CHUNK_SIZE = 64 * 1024
 
 # Optional imports with graceful fallback
 try:
-    import pytesseract
+    from tesserocr import PyTessBaseAPI
+    # Keep a single Tesseract instance alive so tessdata is loaded once, not once per page.
+    # Spawned OCR workers run this at import too, so each loads it once for its whole lifetime.
+    _TESS_API = PyTessBaseAPI(lang="eng")
+    # Pages are rendered at a fixed DPI, so tell Tesseract the real scale for layout analysis
+    _TESS_API.SetVariable("user_defined_dpi", str(OCR_DPI))
+    # PyTessBaseAPI is not thread-safe and FastAPI runs handlers in a threadpool
+    _TESS_LOCK = threading.Lock()
     HAS_OCR = True
 except:
     HAS_OCR = False
-    print("Warning: pytesseract not available. OCR will be disabled.")
+    print("Warning: tesserocr not available. OCR will be disabled.")
 
-try:
-    import spacy
-    try:
-        nlp = spacy.load("en_core_web_sm")
-        HAS_SPACY = True
-    except OSError:
-        nlp = None
-        HAS_SPACY = False
-        print("Warning: spacy 'en_core_web_sm' model not found. NER pre-processing will be skipped.")
-except:
-    nlp = None
-    HAS_SPACY = False
-    print("Warning: spacy not available. NER pre-processing will be skipped.")
+# spaCy NER is opt-in: the regex extractor covers the common fields, and skipping the model
+# saves its load time and several hundred MB of memory. The model is loaded on first use
+# (or at server startup) rather than at import, so spawned OCR workers never load it.
+USE_SPACY_NER = os.getenv("USE_SPACY_NER", "").lower() in ("1", "true", "yes")
+nlp = None
+HAS_SPACY = False
+_nlp_loaded = False
+_nlp_lock = threading.Lock()
+
+def _load_nlp() -> None:
+    """Loads the spaCy model once if USE_SPACY_NER is set, setting nlp and HAS_SPACY."""
+    global nlp, HAS_SPACY, _nlp_loaded
+    with _nlp_lock:
+        if _nlp_loaded or not USE_SPACY_NER:
+            return
+        _nlp_loaded = True
+        try:
+            import spacy
+            try:
+                # Only NER is used, so exclude the rest of the pipeline entirely: disable= would still
+                # load their weights. ner has its own embedding layer, so the shared tok2vec goes too.
+                nlp = spacy.load(
+                    "en_core_web_sm",
+                    exclude=["tok2vec", "tagger", "parser", "senter", "attribute_ruler", "lemmatizer"],
+                )
+                HAS_SPACY = True
+            except OSError:
+                print("Warning: spacy 'en_core_web_sm' model not found. Falling back to regex entity extraction.")
+        except:
+            print("Warning: spacy not available. Falling back to regex entity extraction.")
+
+import google.generativeai as genai
+from google.ai import generativelanguage as glm
 
 try:
     import instructor
-    import google.generativeai as genai
     HAS_INSTRUCTOR = True
 except:
-    import google.generativeai as genai
     HAS_INSTRUCTOR = False
     print("Warning: instructor library not available. Using standard Gemini API.")
 
-load_dotenv()
-
 app = FastAPI(title="CV Parser MVP")
 
 # Define the precise structured output using Pydantic
@@ -72,72 +115,461 @@ class CVData(BaseModel):
     experience: List[Experience]
     skills: List[str]
 
+# Content-addressed cache of parse results: pipeline version + sha256(file bytes) -> parsed JSON text.
+# Hot entries live in a bounded in-memory LRU, backed by SQLite so they survive restarts.
+# Bump PIPELINE_VERSION whenever extraction or prompts change, so stale results stop being served.
+PIPELINE_VERSION = "3"
+GEMINI_MODEL = "gemini-2.5-flash"
+PARSE_CACHE_SIZE = 512
+PARSE_CACHE_PATH = os.getenv("CV_CACHE_PATH", "cv_cache.sqlite3")
+# Stored CVs are personal data, so on-disk entries expire and the table is capped
+PARSE_CACHE_TTL_SECONDS = int(os.getenv("CV_CACHE_TTL_DAYS", "7")) * 24 * 60 * 60
+PARSE_CACHE_MAX_ROWS = 5000
+_parse_cache: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+_parse_cache_lock = threading.Lock()
+
+def _open_cache_db() -> Optional[sqlite3.Connection]:
+    try:
+        conn = sqlite3.connect(PARSE_CACHE_PATH, check_same_thread=False)
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS parse_results (key TEXT PRIMARY KEY, data TEXT NOT NULL, created_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS parse_results_created_at ON parse_results (created_at)")
+        return conn
+    except sqlite3.Error as e:
+        print(f"Warning: parse cache database unavailable, caching in memory only: {e}")
+        return None
+
+# One connection per process, opened on first use so OCR workers (which never touch the
+# cache) don't open it; sqlite3 connections are not safe for concurrent use
+_cache_db: Optional[sqlite3.Connection] = None
+_cache_db_opened = False
+_cache_db_lock = threading.Lock()
+
+def _get_cache_db() -> Optional[sqlite3.Connection]:
+    """Returns the cache connection, opening it on the first call. Call with _cache_db_lock held."""
+    global _cache_db, _cache_db_opened
+    if not _cache_db_opened:
+        _cache_db_opened = True
+        _cache_db = _open_cache_db()
+    return _cache_db
+
+def _hash_file(file_obj: BinaryIO) -> str:
+    """Returns the SHA-256 of a file in chunks, leaving it rewound for the extractors."""
+    hasher = hashlib.sha256()
+    file_obj.seek(0)
+    while chunk := file_obj.read(UPLOAD_CHUNK_SIZE):
+        hasher.update(chunk)
+    file_obj.seek(0)
+    return hasher.hexdigest()
+
+def parse_cache_key(digest: str) -> str:
+    """Versions a file hash with everything that shapes the parse result."""
+    mode = "instructor" if HAS_INSTRUCTOR else "json"
+    ner = "spacy" if HAS_SPACY else "regex"
+    return f"{PIPELINE_VERSION}:{GEMINI_MODEL}:{mode}:{ner}:{digest}"
+
+def _remember(key: str, created_at: float, data: str) -> None:
+    with _parse_cache_lock:
+        _parse_cache[key] = (created_at, data)
+        _parse_cache.move_to_end(key)
+        if len(_parse_cache) > PARSE_CACHE_SIZE:
+            _parse_cache.popitem(last=False)
+
+def get_cached_parse(key: str) -> Optional[str]:
+    """Returns a previously parsed, unexpired result for this key, or None. Blocks on disk I/O."""
+    cutoff = time.time() - PARSE_CACHE_TTL_SECONDS
+    with _parse_cache_lock:
+        entry = _parse_cache.get(key)
+        if entry is not None and entry[0] >= cutoff:
+            _parse_cache.move_to_end(key)
+            return entry[1]
+    try:
+        with _cache_db_lock:
+            db = _get_cache_db()
+            if db is None:
+                return None
+            row = db.execute(
+                "SELECT created_at, data FROM parse_results WHERE key = ? AND created_at >= ?", (key, cutoff)
+            ).fetchone()
+    except sqlite3.Error as e:
+        print(f"Parse cache lookup failed: {e}")
+        return None
+    if row is None:
+        return None
+    _remember(key, row[0], row[1])
+    return row[1]
+
+def store_cached_parse(key: str, data: str) -> None:
+    """Stores a parsed result in memory and on disk, pruning expired rows. Failures never break the request."""
+    now = time.time()
+    _remember(key, now, data)
+    try:
+        with _cache_db_lock:
+            db = _get_cache_db()
+            if db is None:
+                return
+            with db:
+                db.execute("INSERT OR REPLACE INTO parse_results (key, data, created_at) VALUES (?, ?, ?)", (key, data, now))
+                db.execute("DELETE FROM parse_results WHERE created_at < ?", (now - PARSE_CACHE_TTL_SECONDS,))
+                db.execute(
+                    "DELETE FROM parse_results WHERE key NOT IN (SELECT key FROM parse_results ORDER BY created_at DESC LIMIT ?)",
+                    (PARSE_CACHE_MAX_ROWS,),
+                )
+    except sqlite3.Error as e:
+        print(f"Parse cache write failed: {e}")
+
+# Regex entity extraction: a single C-level scan instead of a neural forward pass per token
+_EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+_URL_RE = re.compile(r"(?i:https?://|www\.|(?:linkedin|github)\.com/)[^\s,;]+")
+_PHONE_RE = re.compile(r"\+?\(?\d[\d ().-]{7,}\d")
+# Runs of up to five capitalised words on one line, optionally followed by a company suffix.
+# Letters are Unicode ([^\W\d_]) so names like "García" or "O'Brien" match whole; the first-letter
+# class only rules out ASCII lowercase, so extract_entities re-checks capitalisation.
+_NAME_WORD = r"[^\W\d_a-z][^\W\d_]*(?:['’-][^\W\d_]+)*"
+_NAME_RE = re.compile(
+    rf"\b{_NAME_WORD}(?:[ \t]+{_NAME_WORD}){{0,4}}(?!\w)(?:,?[ \t]+(?:Inc|LLC|Ltd|Corp|GmbH|PLC)(?!\w)\.?)?"
+)
+_ENTITY_RE = re.compile("|".join(
+    f"(?P<{name}>{rx.pattern})"
+    for name, rx in (("EMAIL", _EMAIL_RE), ("URL", _URL_RE), ("PHONE", _PHONE_RE), ("NAME", _NAME_RE))
+))
+_ORG_KEYWORDS = {
+    "Inc", "LLC", "Ltd", "Corp", "Corporation", "Company", "GmbH", "PLC", "Group", "Technologies",
+    "Solutions", "Systems", "Labs", "Bank", "University", "College", "Institute", "School", "Academy",
+}
+# Phrases containing these are job titles, degrees or section headings, not useful hints
+_PHRASE_STOPWORDS = {
+    "Senior", "Junior", "Lead", "Principal", "Head", "Chief", "Intern", "Engineer", "Engineering",
+    "Developer", "Manager", "Analyst", "Consultant", "Director", "Designer", "Architect", "Specialist",
+    "Officer", "Scientist", "Administrator", "Assistant", "Associate", "Software", "Science", "Sciences",
+    "Bachelor", "Bachelors", "Master", "Masters", "Degree", "Diploma", "Studies", "Experience",
+    "Education", "Skills", "Summary", "Profile", "Projects", "Certifications", "References",
+}
+
 def extract_entities(text: str) -> dict:
-    """Uses NLP to extract ORG, PERSON, and GPE entities as hints for the LLM."""
-    if not HAS_SPACY or not nlp:
-        return {"ORG": [], "PERSON": [], "GPE": []}
-    
-    # Process the first 10,000 characters to avoid huge CPU overhead on large docs
-    doc = nlp(text[:10000])
-    entities = {"ORG": set(), "PERSON": set(), "GPE": set()}
-    
-    for ent in doc.ents:
-        if ent.label_ in entities:
-            # Clean up newlines in entity text
-            entities[ent.label_].add(ent.text.replace("\n", " ").strip())
+    """Extracts contact details plus organisations and names as hints for the LLM.
+
+    With spaCy enabled, ORG/PERSON/GPE come from its NER. Otherwise ORG is keyword-matched and
+    the remaining capitalised phrases land in PHRASE, since regex can't tell people from places.
+    """
+    # The CV header carries nearly all name/contact/recent-employer signal, so only the
+    # first 3,000 characters are scanned
+    head = text[:3000]
+    # Dicts keep first-seen order, so entities near the top of the CV survive the cap below
+    entities = {"ORG": {}, "PERSON": {}, "GPE": {}, "PHRASE": {}, "EMAIL": {}, "PHONE": {}, "URL": {}}
+
+    for match in _ENTITY_RE.finditer(head):
+        kind, value = match.lastgroup, match.group().strip()
+        if kind == "NAME":
+            value = " ".join(value.split())
+            words = [word.rstrip(".,") for word in value.split()]
+            if not all(word[0].isupper() for word in words):
+                continue
+            if any(word in _ORG_KEYWORDS for word in words):
+                entities["ORG"][value] = None
+            elif len(words) > 1 and not any(word in _PHRASE_STOPWORDS for word in words):
+                # Single capitalised words are mostly section headings
+                entities["PHRASE"][value] = None
+        elif kind == "PHONE":
+            # Skip date ranges and other short digit runs
+            if sum(c.isdigit() for c in value) >= 9:
+                entities["PHONE"][value] = None
+        else:
+            entities[kind][value.rstrip(".,)")] = None
+
+    _load_nlp()
+    if HAS_SPACY and nlp:
+        # Statistical NER replaces the capitalised-phrase guesses when enabled
+        for label in ("ORG", "PHRASE"):
+            entities[label] = {}
+        for ent in nlp(head).ents:
+            if ent.label_ in ("ORG", "PERSON", "GPE"):
+                # Clean up newlines in entity text
+                entities[ent.label_][ent.text.replace("\n", " ").strip()] = None
             
     # Limit to top 15 distinct entities per category to prevent prompt bloating
     return {k: list(v)[:15] for k, v in entities.items()}
 
-def extract_text_from_pdf(file_bytes: bytes) -> str:
-    """Extracts text using pdfplumber for layout, with OCR fallback."""
-    text = ""
-    
-    # Strategy 1: Layout-aware extraction with pdfplumber
+def _ocr_render(page: "fitz.Page") -> str:
+    """Renders a PDF page to an image and runs OCR on it."""
+    # Render page straight to grayscale (1 byte/pixel instead of 3); Tesseract binarises anyway.
+    # samples_mv is a view of the pixmap's memory (pix.samples would be a bytes copy), so this
+    # only wraps it; pix must stay alive until the filter below has read it.
+    pix = page.get_pixmap(dpi=OCR_DPI, colorspace=fitz.csGRAY)
+    img = Image.frombuffer("L", (pix.width, pix.height), pix.samples_mv, "raw", "L", pix.stride, 1)
+
+    # Sharpen glyph edges to recover the detail lost by the lower render resolution
+    img = img.filter(ImageFilter.UnsharpMask(radius=2, percent=150, threshold=3))
+    bands = len(img.getbands())
+
+    # Perform OCR on the raw pixels; SetImage(img) would PNG-encode the image for Leptonica first.
+    # tobytes() copies the filtered image once, which the unsharp mask makes unavoidable.
+    with _TESS_LOCK:
+        _TESS_API.SetImageBytes(img.tobytes(), img.width, img.height, bands, img.width * bands)
+        return _TESS_API.GetUTF8Text()
+
+def _ocr_pages(file_bytes: bytes, page_indices: List[int]) -> List[str]:
+    """Runs OCR on a run of pages from one PDF. Runs inside a worker process."""
+    with fitz.open(stream=file_bytes, filetype="pdf") as doc:
+        return [_ocr_render(doc[i]) for i in page_indices]
+
+# Multi-page scans are OCR'd in one long-lived, bounded pool shared by all requests and created
+# on first use. Workers are spawned rather than forked so they never inherit the server's
+# threads or the Gemini clients' gRPC channels.
+OCR_WORKERS = max(1, min(4, os.cpu_count() or 1))
+_ocr_pool: Optional[ProcessPoolExecutor] = None
+_ocr_pool_lock = threading.Lock()
+
+def _get_ocr_pool() -> ProcessPoolExecutor:
+    global _ocr_pool
+    with _ocr_pool_lock:
+        if _ocr_pool is None:
+            _ocr_pool = ProcessPoolExecutor(
+                max_workers=OCR_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _ocr_pool
+
+def _discard_ocr_pool(pool: ProcessPoolExecutor) -> None:
+    """Shuts down `pool`, e.g. after a worker died, so the next scan starts a fresh one.
+
+    Only clears the shared pool if it is still `pool`; another request may already have
+    replaced a broken pool with a healthy one.
+    """
+    global _ocr_pool
+    with _ocr_pool_lock:
+        if _ocr_pool is pool:
+            _ocr_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+@app.on_event("shutdown")
+def _shutdown_ocr_pool() -> None:
+    pool = _ocr_pool
+    if pool is not None:
+        _discard_ocr_pool(pool)
+
+def extract_text_from_pdf(file_obj: BinaryIO) -> str:
+    """Extracts text in reading order using PyMuPDF, with OCR fallback."""
+    # PyMuPDF's stream= needs bytes, and so do the OCR workers; this is the one full read
+    file_bytes = file_obj.read()
     try:
-        with pdfplumber.open(BytesIO(file_bytes)) as pdf:
-            for page in pdf.pages:
-                # layout=True preserves visual columns and tables better than standard extraction
-                page_text = page.extract_text(layout=True)
-                if page_text:
-                    text += page_text + "\n"
+        doc = fitz.open(stream=file_bytes, filetype="pdf")
     except Exception as e:
-        print(f"pdfplumber failed: {e}")
-        pass
+        raise ValueError(f"Failed to open PDF: {str(e)}")
 
-    # Strategy 2: OCR Fallback if text is unusually sparse (e.g. < 50 chars indicates an image PDF)
-    if len(text.strip()) < 50:
-        if not HAS_OCR:
-            raise ValueError("Document appears to be scanned/image-based but OCR (pytesseract) is not available.")
-        
-        print("Scanned document detected. Initiating OCR fallback...")
-        text = ""
+    # One document handle serves text extraction and single-page OCR. Multi-page scans are
+    # OCR'd in worker processes, which each open their own copy once per run of pages.
+    try:
+        # Strategy 1: Fast layout-aware extraction with PyMuPDF
+        parts = []
         try:
-            doc = fitz.open("pdf", file_bytes)
-            for page in doc:
-                # Render page to an image
-                pix = page.get_pixmap(dpi=300)
-                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                
-                # Perform OCR
-                page_text = pytesseract.image_to_string(img)
-                text += page_text + "\n"
+            for page_index, page in enumerate(doc.pages()):
+                # sort=True orders blocks top-to-bottom, then left-to-right, to keep reading order across columns
+                parts.append(page.get_text("text", sort=True))
+                # Two near-empty opening pages mean a scan, so stop probing and go straight to OCR.
+                # Without OCR keep reading: later pages may still carry real text.
+                if HAS_OCR and page_index == 1 and sum(len(p.strip()) for p in parts) < 50:
+                    break
         except Exception as e:
-            raise ValueError(f"Failed to perform OCR on PDF: {str(e)}")
+            print(f"PyMuPDF text extraction failed: {e}")
+        text = "\n".join(parts)
+
+        # Strategy 2: OCR Fallback if text is unusually sparse (e.g. < 50 chars indicates an image PDF)
+        if len(text.strip()) < 50:
+            if not HAS_OCR:
+                raise ValueError("Document appears to be scanned/image-based but OCR (tesserocr) is not available.")
+            
+            print("Scanned document detected. Initiating OCR fallback...")
+            pool = None
+            try:
+                if doc.page_count == 0:
+                    # Nothing to OCR; falls through to the empty-document error below
+                    parts = []
+                elif doc.page_count == 1:
+                    # Not worth a process pool; OCR the page from the already-open document
+                    parts = [_ocr_render(doc[0])]
+                else:
+                    # Pages are independent and Tesseract is CPU-bound, so spread them across cores.
+                    # Each worker gets one contiguous run of pages: the PDF is sent and opened once
+                    # per run rather than once per page.
+                    pool = _get_ocr_pool()
+                    run = -(-doc.page_count // OCR_WORKERS)
+                    futures = [
+                        pool.submit(_ocr_pages, file_bytes, list(range(start, min(start + run, doc.page_count))))
+                        for start in range(0, doc.page_count, run)
+                    ]
+                    parts = [page_text for future in futures for page_text in future.result()]
+            except BrokenProcessPool as e:
+                if pool is not None:
+                    _discard_ocr_pool(pool)
+                raise ValueError(f"Failed to perform OCR on PDF: {str(e)}")
+            except Exception as e:
+                raise ValueError(f"Failed to perform OCR on PDF: {str(e)}")
+            text = "\n".join(parts)
+    finally:
+        doc.close()
 
     if not text.strip():
         raise ValueError("Document appears to be entirely empty or unreadable.")
 
     return text
 
-def extract_text_from_docx(file_bytes: bytes) -> str:
+def extract_text_from_docx(file_obj: BinaryIO) -> str:
     # docx requires a file-like object
     try:
-        doc = docx.Document(BytesIO(file_bytes))
+        doc = docx.Document(file_obj)
         return "\n".join([para.text for para in doc.paragraphs])
     except Exception as e:
         raise ValueError(f"Failed to parse DOCX: {str(e)}")
 
+# Extracted DOCX text keyed by upload hash. The parse cache only fills once the LLM call
+# succeeds, so retries of a failed parse would otherwise re-unzip and re-parse the OOXML.
+DOCX_TEXT_CACHE_SIZE = 128
+_docx_text_cache: "OrderedDict[str, str]" = OrderedDict()
+_docx_text_cache_lock = threading.Lock()
+
+def extract_text_from_docx_cached(file_obj: BinaryIO, digest: str) -> str:
+    """Like extract_text_from_docx, but memoized on `digest`, the hash of the file's bytes."""
+    with _docx_text_cache_lock:
+        if digest in _docx_text_cache:
+            _docx_text_cache.move_to_end(digest)
+            return _docx_text_cache[digest]
+    text = extract_text_from_docx(file_obj)
+    with _docx_text_cache_lock:
+        _docx_text_cache[digest] = text
+        if len(_docx_text_cache) > DOCX_TEXT_CACHE_SIZE:
+            _docx_text_cache.popitem(last=False)
+    return text
+
+# JSON-mode config for the plain Gemini fallback, built once at import rather than per client.
+# Hand-written because the SDK's response_schema doesn't accept the $ref/$defs that
+# CVData.model_json_schema() emits.
+CV_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "object",
+        "properties": {
+            "name": {"type": "string"},
+            "contact_info": {
+                "type": "object",
+                "properties": {
+                    "email": {"type": "string"},
+                    "phone": {"type": "string"},
+                    "linkedin": {"type": "string"},
+                    "github": {"type": "string"}
+                }
+            },
+            "education": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "institution": {"type": "string"},
+                        "degree": {"type": "string"},
+                        "graduation_year": {"type": "string"}
+                    }
+                }
+            },
+            "experience": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "company": {"type": "string"},
+                        "role": {"type": "string"},
+                        "start_date": {"type": "string"},
+                        "end_date": {"type": "string"},
+                        "description": {"type": "string"}
+                    }
+                }
+            },
+            "skills": {
+                "type": "array",
+                "items": {"type": "string"}
+            }
+        },
+        "required": ["name", "contact_info", "education", "experience", "skills"]
+    }
+}
+
+# Gemini clients are cached per API key so each request doesn't rebuild the model and
+# Instructor wrapper. The key is bound to the client itself rather than set globally with
+# genai.configure, so concurrent requests with different keys can't race each other.
+# Keys come from an untrusted form field and each client holds a gRPC channel, so the cache is
+# a bounded LRU like the parse cache rather than growing with every key ever submitted.
+CLIENT_CACHE_SIZE = 32
+_client_cache: "OrderedDict[str, Any]" = OrderedDict()
+_client_cache_lock = threading.Lock()
+
+def _make_client(api_key: str) -> Any:
+    """Builds a Gemini client bound to `api_key`: an Instructor wrapper if available, else a JSON-mode model."""
+    # google-generativeai offers no public per-model key, so the service client is attached via the
+    # private GenerativeModel._client, which generate_content uses when set (SDK 0.8.x internals)
+    service_client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+    if HAS_INSTRUCTOR:
+        # Use instructor for guaranteed structured output
+        base_model = genai.GenerativeModel(GEMINI_MODEL)
+        base_model._client = service_client
+        return instructor.from_gemini(
+            client=base_model,
+            mode=instructor.Mode.GEMINI_JSON
+        )
+
+    # Use standard Gemini API with JSON mode
+    model = genai.GenerativeModel(
+        GEMINI_MODEL,
+        generation_config=CV_GENERATION_CONFIG
+    )
+    model._client = service_client
+    return model
+
+def get_client(api_key: str) -> Any:
+    """Returns the cached Gemini client for `api_key`, building it on first use."""
+    # The server's own key is pinned on app.state at startup, outside the LRU, so a flood of
+    # user-supplied keys can never evict it
+    if api_key == getattr(app.state, "default_key", None):
+        return app.state.default_client
+    with _client_cache_lock:
+        client = _client_cache.get(api_key)
+        if client is None:
+            client = _make_client(api_key)
+            _client_cache[api_key] = client
+            if len(_client_cache) > CLIENT_CACHE_SIZE:
+                _client_cache.popitem(last=False)
+        else:
+            _client_cache.move_to_end(api_key)
+        return client
+
+def _parse_with_instructor(api_key: str, prompt: str) -> CVData:
+    """Looks up the key's client and runs the Instructor call. Blocking; run in the threadpool."""
+    # Using Instructor to enforce the CVData schema directly
+    return get_client(api_key).chat.completions.create(
+        messages=[{"role": "user", "content": prompt}],
+        response_model=CVData,
+        max_retries=3
+    )
+
+def _parse_with_gemini(api_key: str, prompt: str) -> str:
+    """Looks up the key's client and runs the JSON-mode call. Blocking; run in the threadpool."""
+    return get_client(api_key).generate_content(prompt).text
+
+@app.on_event("startup")
+async def _warmup_nlp() -> None:
+    """Loads the optional spaCy model at boot, before cache keys and prompts depend on HAS_SPACY."""
+    await run_in_threadpool(_load_nlp)
+
+@app.on_event("startup")
+async def _warmup_client() -> None:
+    """Builds and pins the client for the server's own GEMINI_API_KEY at boot, so requests using it never pay for it."""
+    default_key = os.getenv("GEMINI_API_KEY", "").strip()
+    if not default_key:
+        return
+    try:
+        app.state.default_client = await run_in_threadpool(_make_client, default_key)
+        app.state.default_key = default_key
+    except Exception as e:
+        print(f"Warning: could not preload Gemini client: {e}")
+
 @app.post("/api/parse-cv")
 async def parse_cv(file: UploadFile = File(...), api_key: str = Form(...)):
     # Check API key inside route so we can show proper error if missing
@@ -145,47 +577,59 @@ async def parse_cv(file: UploadFile = File(...), api_key: str = Form(...)):
     if not current_key:
         raise HTTPException(status_code=400, detail="Gemini API Key is required.")
     
-    # Configure each time with user's key
-    genai.configure(api_key=current_key)
-    
-    content = await file.read()
     filename = file.filename.lower()
+    if not filename.endswith((".pdf", ".docx")):
+        raise HTTPException(status_code=400, detail="Only PDF and DOCX files are supported.")
+
+    # Starlette already spools uploads (in memory up to 1 MB, then on disk), so work on that
+    # file directly instead of copying it again
+    digest = await run_in_threadpool(_hash_file, file.file)
+
+    # Identical uploads skip extraction, NER and the Gemini round-trip entirely
+    cache_key = parse_cache_key(digest)
+    cached = await run_in_threadpool(get_cached_parse, cache_key)
+    if cached is not None:
+        return Response(content=cached, media_type="application/json")
     
+    # Extraction, NER and the sync Gemini SDK all block, so they run in the threadpool
+    # to keep the event loop free for other requests
     if filename.endswith(".pdf"):
         try:
-            text = extract_text_from_pdf(content)
+            text = await run_in_threadpool(extract_text_from_pdf, file.file)
         except ValueError as ve:
             raise HTTPException(status_code=400, detail=str(ve))
-    elif filename.endswith(".docx"):
+    else:
         try:
-            text = extract_text_from_docx(content)
+            # python-docx reads the file object directly, no extra BytesIO copy
+            text = await run_in_threadpool(extract_text_from_docx_cached, file.file, digest)
         except ValueError as ve:
             raise HTTPException(status_code=400, detail=str(ve))
-    else:
-        raise HTTPException(status_code=400, detail="Only PDF and DOCX files are supported.")
         
     if not text.strip():
         raise HTTPException(status_code=400, detail="Could not extract text from the document. It might be empty or an image-based PDF.")
 
+    prompt_text = text[:MAX_PROMPT_CHARS]
+
     # 1. NLP Pre-processing: Identify named entities for context
-    entities = extract_entities(text)
+    entities = await run_in_threadpool(extract_entities, text)
+    # Only offer the hint categories the active extractor can actually tell apart
+    if HAS_SPACY:
+        hint_labels = [("ORG", "Organizations/Companies"), ("GPE", "Locations"), ("PERSON", "People")]
+    else:
+        hint_labels = [("ORG", "Organizations/Companies"), ("PHRASE", "Capitalised phrases (may include names or places)")]
+    hint_labels += [("EMAIL", "Emails"), ("PHONE", "Phone numbers"), ("URL", "Links")]
+    hint_lines = "\n".join(
+        f"    {label} found: {', '.join(entities[key]) if entities[key] else 'None identified'}"
+        for key, label in hint_labels
+    )
     entity_context = f"""
     [Hints from NLP Pre-processing]
-    Organizations/Companies found: {', '.join(entities['ORG']) if entities['ORG'] else 'None identified'}
-    Locations found: {', '.join(entities['GPE']) if entities['GPE'] else 'None identified'}
-    People found: {', '.join(entities['PERSON']) if entities['PERSON'] else 'None identified'}
+{hint_lines}
     """
 
     # Call Gemini API with or without Instructor for Structured Output
     try:
         if HAS_INSTRUCTOR:
-            # Use instructor for guaranteed structured output
-            base_model = genai.GenerativeModel('gemini-2.5-flash')
-            client = instructor.from_gemini(
-                client=base_model,
-                mode=instructor.Mode.GEMINI_JSON
-            )
-            
             prompt = f"""
             Extract the following information from the resume text provided below. 
             Ensure extreme precision and accuracy. If a piece of information is missing, output an empty string or null.
@@ -194,70 +638,16 @@ async def parse_cv(file: UploadFile = File(...), api_key: str = Form(...)):
             {entity_context}
             
             Resume text:
-            {text}
+            {prompt_text}
             """
 
-            # Using Instructor to enforce the CVData schema directly
-            parsed_data = client.chat.completions.create(
-                messages=[{"role": "user", "content": prompt}],
-                response_model=CVData,
-                max_retries=3
-            )
+            parsed_data = await run_in_threadpool(_parse_with_instructor, current_key, prompt)
             
-            return parsed_data.model_dump()
+            # Serialize straight to JSON text instead of a dict FastAPI would re-encode
+            result = parsed_data.model_dump_json()
+            await run_in_threadpool(store_cached_parse, cache_key, result)
+            return Response(content=result, media_type="application/json")
         else:
-            # Use standard Gemini API with JSON mode
-            model = genai.GenerativeModel(
-                'gemini-2.5-flash',
-                generation_config={
-                    "response_mime_type": "application/json",
-                    "response_schema": {
-                        "type": "object",
-                        "properties": {
-                            "name": {"type": "string"},
-                            "contact_info": {
-                                "type": "object",
-                                "properties": {
-                                    "email": {"type": "string"},
-                                    "phone": {"type": "string"},
-                                    "linkedin": {"type": "string"},
-                                    "github": {"type": "string"}
-                                }
-                            },
-                            "education": {
-                                "type": "array",
-                                "items": {
-                                    "type": "object",
-                                    "properties": {
-                                        "institution": {"type": "string"},
-                                        "degree": {"type": "string"},
-                                        "graduation_year": {"type": "string"}
-                                    }
-                                }
-                            },
-                            "experience": {
-                                "type": "array",
-                                "items": {
-                                    "type": "object",
-                                    "properties": {
-                                        "company": {"type": "string"},
-                                        "role": {"type": "string"},
-                                        "start_date": {"type": "string"},
-                                        "end_date": {"type": "string"},
-                                        "description": {"type": "string"}
-                                    }
-                                }
-                            },
-                            "skills": {
-                                "type": "array",
-                                "items": {"type": "string"}
-                            }
-                        },
-                        "required": ["name", "contact_info", "education", "experience", "skills"]
-                    }
-                }
-            )
-            
             prompt = f"""
             Extract the following information from the resume text provided below and return it as JSON.
             Ensure extreme precision and accuracy. If a piece of information is missing, use empty string or empty array.
@@ -266,11 +656,14 @@ async def parse_cv(file: UploadFile = File(...), api_key: str = Form(...)):
             {entity_context}
             
             Resume text:
-            {text}
+            {prompt_text}
             """
             
-            response = model.generate_content(prompt)
-            return json.loads(response.text)
+            # Gemini already returns JSON text; validate it, but send it on as-is
+            result = await run_in_threadpool(_parse_with_gemini, current_key, prompt)
+            json.loads(result)
+            await run_in_threadpool(store_cached_parse, cache_key, result)
+            return Response(content=result, media_type="application/json")
         
     except Exception as e:
         print(f"AI Parsing error detail: {str(e)}")